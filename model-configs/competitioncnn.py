@@ -42,3 +42,4 @@ batch_size = 32                                     # The size of batch inputs
 learning_rate = 1e-4                                # The learning rate of the optimising algorithm
 loss = "SAD"                                        # Loss function to be optimized (SAD or MSE)
 gradient_clip = 5.0                                 # Gradient clipping by norm threshold
+summary_steps = 100                                 # Number of training steps between logged summaries
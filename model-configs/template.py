@@ -47,3 +47,4 @@ loss = "SAD"                                        # Loss function to be optimi
 fractional_pixel = "x,y"                            # x,y pair of the interpolated fractional pixel [0,4 , ..., 12,12]
 qp = 27                                             # Quantization Parameter of produced dataset [22, 27, 32, 37]
 gradient_clip = 5.0                                 # Gradient clipping by norm threshold
+summary_steps = 100                                 # Number of training steps between logged summaries
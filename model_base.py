@@ -47,8 +47,9 @@ class BaseCNN(object):
         self.sess = sess
         self.cfg = cfg
 
-        self.inputs = tf.placeholder(tf.float32, [None, None, None, 1], name='inputs')
-        self.labels = tf.placeholder(tf.float32, [None, None, None, 1], name='labels')
+        # a single dictionary is reused for feeding every batch
+        self.feed_dict = {}
+        self.inputs, self.labels = self.input_tensors()
 
         self.weights = None
         self.loss = None
@@ -61,6 +62,16 @@ class BaseCNN(object):
         self.minimum = sys.maxsize
         self.counter = 0
 
+    def input_tensors(self):
+        """
+        Create the inputs / labels of the model as placeholders, fed batch by batch
+        :return: inputs and labels tensors
+        """
+        inputs = tf.placeholder(tf.float32, [None, None, None, 1], name='inputs')
+        labels = tf.placeholder(tf.float32, [None, None, None, 1], name='labels')
+
+        return inputs, labels
+
     def initialize_graph(self, graphs_subdir):
         """
         Initialize TensorBoard summaries
@@ -69,7 +80,6 @@ class BaseCNN(object):
         """
         tf.global_variables_initializer().run()
         # make summary
-        tf.summary.scalar('loss', self.loss)
         tf.summary.scalar('learning rate', self.cfg.learning_rate)
         for w in self.weights:
             tf.summary.histogram(w, self.weights[w])
@@ -81,24 +91,32 @@ class BaseCNN(object):
         sub_dir = os.path.join(self.cfg.graphs_dir, graphs_subdir)
         os.makedirs(sub_dir, exist_ok=True)
 
+        merged = self.merge_summaries()
         writer = tf.summary.FileWriter(sub_dir, self.sess.graph)
-        merged = tf.summary.merge_all()
 
         return writer, merged
 
+    def merge_summaries(self):
+        """
+        Add the loss to the summaries and merge them
+        :return: merged summaries
+        """
+        tf.summary.scalar('loss', self.loss)
+
+        return tf.summary.merge_all()
+
     def prepare_feed_dict(self, inputs, labels, i):
         """
         Method that prepares a batch of inputs / labels to be fed into the model
         :param inputs: input data
         :param labels: label data
         :param i: index pointing to the current position within the data
-        :return a batch-sized dictionary of inputs / labels
+        :return a batch-sized dictionary of inputs / labels, updated in place for each batch
         """
-        batch_inputs = inputs[i * self.cfg.batch_size: (i + 1) * self.cfg.batch_size]
-        batch_labels = labels[i * self.cfg.batch_size: (i + 1) * self.cfg.batch_size]
-        feed_dict = {self.inputs: batch_inputs, self.labels: batch_labels}
+        self.feed_dict[self.inputs] = inputs[i * self.cfg.batch_size: (i + 1) * self.cfg.batch_size]
+        self.feed_dict[self.labels] = labels[i * self.cfg.batch_size: (i + 1) * self.cfg.batch_size]
 
-        return feed_dict
+        return self.feed_dict
 
     def save_epoch(self, current_epoch, current_step, start_time, train_error, val_error, model_subdir):
         """
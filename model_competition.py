@@ -42,13 +42,23 @@ class CompetitionBaseCNN(BaseCNN):
     """
     Class for the base CNN for shared models that contains generalised parameters and functions
     """
-    def __init__(self, sess, cfg):
+    def __init__(self, sess, cfg, num_branches):
+        """
+        Initialise the CompetitionBaseCNN model
+        :param sess: TensorFlow session
+        :param cfg: model details taken from the config file
+        :param num_branches: number of branches of the output layer, one per fractional position
+        """
+        # needed by the input pipeline, which is built by the base constructor
+        self.num_branches = num_branches
         super().__init__(sess, cfg)
 
-        self.vvc_loss = tf.placeholder(tf.float32, [None], name='vvc_loss')
-        self.epoch = tf.placeholder(tf.int32, name='epoch')
-        self.subset = tf.placeholder(tf.int32, name='subset')
-        self.batch_size = tf.placeholder(tf.int32, name='batch_size')
+        self.stage_losses = None
+        self.train_ops = None
+        self.pred_plus_input = None
+        self.val_steps = None
+        self.val_loss = None
+        self.val_reset = None
 
     def train(self):
         """
@@ -72,69 +82,62 @@ class CompetitionBaseCNN(BaseCNN):
         # calculate number of training / validation batches for each block size per fractional position
         batch_train, batch_val = calculate_batch_number(train_data_sub, val_data_sub, self.cfg.batch_size, nested=True)
 
-        start_epoch = global_step // sum([x*15 for x in batch_train])
+        # prepare the combined data of each block size once, releasing the source data
+        train_schedule = self.block_schedule([x * self.num_branches for x in batch_train],
+                                             train_data, train_label, train_sad)
+        val_schedule = self.block_schedule(batch_val, val_data, val_label, val_sad)
+        del train_data, train_label, train_sad, val_data, val_label, val_sad
+
+        start_epoch = global_step // sum([x * self.num_branches for x in batch_train])
+
+        # the data per fractional position is only kept if the second epoch is still to be trained
+        data_sub = (train_data_sub, train_label_sub, train_sad_sub, val_data_sub, val_label_sub, val_sad_sub) \
+            if start_epoch <= 1 else None
+        del train_data_sub, train_label_sub, train_sad_sub, val_data_sub, val_label_sub, val_sad_sub
+
         print("Training %s network, from epoch %d" % (self.cfg.model_name.upper(), start_epoch))
 
         start_time = time.time()
         err_train = None
         for ep in range(start_epoch, self.cfg.epoch):
             # Training for first epoch where all branches are updated
-            # and for the latter epochs where only the best (and better than VVC) branch is updated
+            # and for the latter epochs where only the best (and better than VVC) branch is updated,
+            # in the second epoch each branch is trained for a particular data subset
             if ep != 1:
-                # Run on batches of combined training inputs
-                for index, block in enumerate(train_data):
-                    for idx in range(batch_train[index] * 15):
-                        feed_dict = self.competition_feed_dict(train_data[block], train_label[block], train_sad[block],
-                                                               idx, ep, 0)
-                        # Run validation to avoid possible issue in latter epochs
-                        # where none of the branches are better than VVC resulting in a nan error
-                        err_valid = self.sess.run([self.loss], feed_dict=feed_dict)
-                        if np.isnan(err_valid[0]):
-                            continue
-                        else:
-                            _, err_train, summary = self.sess.run([self.train_op, self.loss, merged],
-                                                                  feed_dict=feed_dict)
-                            global_step += 1
-                            writer.add_summary(summary, global_step)
-
-                # Run on batches of combined validation inputs
-                error_val_list = []
-                for index, block in enumerate(val_data):
-                    for idx in range(batch_val[index]):
-                        feed_dict = self.competition_feed_dict(val_data[block], val_label[block], val_sad[block],
-                                                               idx, ep, 0)
-                        err_valid = self.sess.run([self.loss], feed_dict=feed_dict)
-                        if np.isnan(err_valid[0]):
-                            continue
-                        error_val_list.append(err_valid[0])
-
-                err_val = sum(error_val_list) / len(error_val_list)
+                train_set, val_set = train_schedule, val_schedule
             else:
-                # First epoch where each branch is trained for a particular data subset
-                # Run on batches of training inputs, per fractional position and block size
-                for index, block in enumerate(train_data_sub):
-                    for idx in range(batch_train[index]):
-                        for i, frac in enumerate(train_data_sub[block]):
-                            feed_dict = self.competition_feed_dict(train_data_sub[block][frac],
-                                                                   train_label_sub[block][frac],
-                                                                   train_sad_sub[block][frac], idx, ep, i)
-                            _, err_train, summary = self.sess.run([self.train_op, self.loss, merged],
-                                                                  feed_dict=feed_dict)
-                            global_step += 1
-                            writer.add_summary(summary, global_step)
-
-                # Run on batches of validation inputs, per fractional position and block size
-                error_val_list = []
-                for index, block in enumerate(val_data_sub):
-                    for idx in range(batch_val[index]):
-                        for i, frac in enumerate(val_data_sub[block]):
-                            feed_dict = self.competition_feed_dict(val_data_sub[block][frac],
-                                                                   val_label_sub[block][frac],
-                                                                   val_sad_sub[block][frac], idx, ep, i)
-                            err_valid = self.sess.run([self.loss], feed_dict=feed_dict)
-                            error_val_list.append(err_valid[0])
-
-                err_val = sum(error_val_list) / len(error_val_list)
+                # prepare the data per fractional position only for the second epoch, then release it
+                train_set = self.block_schedule(batch_train, *data_sub[:3])
+                val_set = self.block_schedule(batch_val, *data_sub[3:])
+                data_sub = None
+
+            # only the loss and the gradients of the current training stage are computed in training steps
+            stage = min(ep, 2)
+            train_fetches = [self.train_ops[stage], self.stage_losses[stage]]
+            summary_fetches = [self.train_ops[stage], self.stage_losses[stage], merged[stage]]
+
+            # Run on batches of training inputs, with a single session run per batch
+            for subsets in self.epoch_steps(train_set):
+                # a batch joining all subsets counts as a step per subset, keeping the same steps in each epoch;
+                # fetch the summaries only every few steps
+                summarize = (global_step + subsets) // self.cfg.summary_steps > global_step // self.cfg.summary_steps
+                res = self.sess.run(summary_fetches if summarize else train_fetches)
+
+                # In latter epochs none of the branches may be better than VVC, resulting in a nan error;
+                # the update is then skipped inside the graph and the step isn't counted
+                if np.isnan(res[1]):
+                    continue
+                err_train = res[1]
+                global_step += subsets
+                if summarize:
+                    writer.add_summary(res[2], global_step)
+
+            # Run on batches of validation inputs, the mean loss is accumulated in the graph
+            self.sess.run(self.val_reset)
+            for _ in self.epoch_steps(val_set):
+                self.sess.run(self.val_steps[stage])
+
+            err_val = self.sess.run(self.val_loss)
 
             # save model if better than previously, check early stopping condition
             counter = self.save_epoch(ep, global_step, start_time, err_train, err_val, self.subdirectory())
@@ -163,14 +166,19 @@ class CompetitionBaseCNN(BaseCNN):
         error_pred, error_vvc, error_blocks = ([] for _ in range(3))
         for block in test_data:
             batch_test = math.ceil(len(test_data[block]) / self.cfg.batch_size)
-            result = np.array([])
+            result = None
+
+            feed_dict = self.competition_feed_dict(test_data[block], test_label[block], test_sad[block])
+            self.sess.run(self.iterator.initializer, feed_dict=feed_dict)
 
             for idx in range(batch_test):
-                feed_dict = self.competition_feed_dict(test_data[block], test_label[block], test_sad[block], idx, 2, 0)
-                res = self.sess.run([self.pred], feed_dict=feed_dict)
-                cropped_input = feed_dict[self.inputs][:, self.half_kernel:-self.half_kernel,
-                                                       self.half_kernel:-self.half_kernel, :]
-                result = np.vstack([result, res[0] + cropped_input]) if result.size else res[0] + cropped_input
+                res = self.sess.run([self.pred_plus_input])
+
+                # allocate the output for the whole block once, then write each batch into its slice
+                if result is None:
+                    result = np.empty((len(test_data[block]),) + res[0].shape[1:], dtype=np.float32)
+                start = idx * self.cfg.batch_size
+                result[start:start + len(res[0])] = res[0]
 
             # calculate SAD NN loss and compare it to VVC loss
             nn_cost, vvc_cost, switch_cost = calculate_test_error(result, test_label[block], test_sad[block])
@@ -187,22 +195,132 @@ class CompetitionBaseCNN(BaseCNN):
         """
         return os.path.join(self.cfg.model_name, self.cfg.dataset_dir.split("/")[1])
 
-    def competition_feed_dict(self, inputs, labels, sad, i, epoch, subset):
+    def input_tensors(self):
+        """
+        Create the inputs / labels of the competition model as outputs of the input pipeline,
+        which is fed once per block size instead of batch by batch
+        :return: inputs and labels tensors
         """
-        Method that prepares a batch of inputs / labels to be fed into the competition model
-        :param inputs: input data
-        :param labels: label data
-        :param sad: SAD loss data
-        :param i: index pointing to the current position within the data
-        :param epoch: current epoch number, needed for choosing the training method in the framework
-        :param subset: index indicating which branch of the output layer to update
-        :return a batch-sized dictionary of inputs / labels / subset / batch_size
+        # data of a block size is fed once, stacked per data subset (a single subset if combined)
+        self.block_inputs = tf.placeholder(tf.float32, [None, None, None, None, 1], name='block_inputs')
+        self.block_labels = tf.placeholder(tf.float32, [None, None, None, None, 1], name='block_labels')
+        self.block_sad = tf.placeholder(tf.float32, [None, None], name='block_sad')
+
+        self.iterator = self.input_pipeline().make_initializable_iterator()
+        inputs, labels, self.vvc_loss, self.subset = self.iterator.get_next()
+
+        return inputs, labels
+
+    def merge_summaries(self):
         """
-        batch_sad = sad[i * self.cfg.batch_size: (i + 1) * self.cfg.batch_size]
-        feed_dict = self.prepare_feed_dict(inputs, labels, i)
-        feed_dict.update({self.vvc_loss: batch_sad, self.epoch: epoch,
-                          self.subset: subset, self.batch_size: len(feed_dict[self.inputs])})
-        return feed_dict
+        Merge the summaries once per training stage, each with the loss of its stage
+        :return: list of merged summaries, indexed by training stage
+        """
+        summaries = tf.summary.merge_all()
+
+        return [tf.summary.merge([summaries, tf.summary.scalar('loss', loss, collections=[], family='stage%d' % stage)])
+                for stage, loss in enumerate(self.stage_losses)]
+
+    def validation_mean(self):
+        """
+        Create the operations that accumulate the validation loss in the graph, skipping batches with a nan loss:
+        a step operation per training stage run per batch, the resulting mean loss and a reset of the accumulators
+        """
+        with tf.variable_scope('validation'):
+            loss_sum = tf.get_variable('loss_sum', initializer=0.0, trainable=False,
+                                       collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            loss_count = tf.get_variable('loss_count', initializer=0.0, trainable=False,
+                                         collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+        self.val_steps = []
+        for loss in self.stage_losses:
+            valid = tf.logical_not(tf.is_nan(loss))
+            self.val_steps.append(tf.group(tf.assign_add(loss_sum, tf.where(valid, loss, tf.zeros_like(loss))),
+                                           tf.assign_add(loss_count, tf.cast(valid, tf.float32))))
+        self.val_loss = loss_sum / loss_count
+        self.val_reset = tf.variables_initializer([loss_sum, loss_count])
+
+    def input_pipeline(self):
+        """
+        Build the input pipeline of the competition model, which batches the fed data of a block size
+        and prefetches the batches (to the GPU if available), so that they are ready when the current batch finishes
+        :return dataset of batched inputs / labels / SAD losses / subset
+        """
+        subsets = tf.data.Dataset.from_tensor_slices((self.block_inputs, self.block_labels, self.block_sad,
+                                                      tf.range(tf.shape(self.block_sad)[0])))
+
+        # batch each subset separately and alternate between them, one batch per subset (fractional position),
+        # every sample carries the index of its subset
+        dataset = subsets.interleave(
+            lambda inputs, labels, sad, subset:
+                tf.data.Dataset.from_tensor_slices((inputs, labels, sad, tf.fill(tf.shape(sad), subset))).batch(
+                    self.cfg.batch_size),
+            cycle_length=self.num_branches, block_length=1)
+
+        # join the batches of all subsets into one, so that all branches are updated in a single step
+        def join_subsets(inputs, labels, sad, subset):
+            inputs = tf.reshape(inputs, [-1, tf.shape(inputs)[2], tf.shape(inputs)[3], 1])
+            labels = tf.reshape(labels, [-1, tf.shape(labels)[2], tf.shape(labels)[3], 1])
+            return inputs, labels, tf.reshape(sad, [-1]), tf.reshape(subset, [-1])
+
+        dataset = dataset.batch(tf.cast(tf.shape(self.block_sad)[0], tf.int64)).map(join_subsets)
+
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+        # if a GPU is available, copy the prefetched batches to it asynchronously, ahead of the current batch
+        gpus = [device.name for device in self.sess.list_devices() if device.device_type == 'GPU']
+        if gpus:
+            dataset = dataset.apply(tf.data.experimental.prefetch_to_device(gpus[0]))
+
+        return dataset
+
+    def block_schedule(self, batches, inputs, labels, sad):
+        """
+        Prepare the data of each block size for the input pipeline, once for all epochs
+        :param batches: number of batches per block size (each joining all fractional positions if separated)
+        :param inputs: input data, per block size (and per fractional position if separated)
+        :param labels: label data, per block size (and per fractional position if separated)
+        :param sad: SAD loss data, per block size (and per fractional position if separated)
+        :return list of dictionaries that initialize the input pipeline, paired with their number of batches
+        """
+        schedule = []
+        for index, block in enumerate(inputs):
+            block_feed_dict = self.competition_feed_dict(inputs[block], labels[block], sad[block])
+            schedule.append((block_feed_dict, batches[index]))
+
+        return schedule
+
+    def epoch_steps(self, schedule):
+        """
+        Generator that initializes the input pipeline for each block size and yields once for each batch,
+        the batches are then run without any feeding
+        :param schedule: prepared data of each block size, paired with its number of batches
+        :return number of subsets joined in the batch
+        """
+        for block_feed_dict, steps in schedule:
+            self.sess.run(self.iterator.initializer, feed_dict=block_feed_dict)
+
+            for _ in range(steps):
+                yield len(block_feed_dict[self.block_sad])
+
+    def competition_feed_dict(self, inputs, labels, sad):
+        """
+        Method that prepares the data of a block size to be fed into the input pipeline of the competition model
+        :param inputs: input data, combined or separated by fractional position
+        :param labels: label data, combined or separated by fractional position
+        :param sad: SAD loss data, combined or separated by fractional position
+        :return a dictionary of inputs / labels / SAD losses, stacked per data subset
+        """
+        if isinstance(inputs, dict):
+            # each fractional position is a subset used for updating its branch of the output layer
+            inputs, labels, sad = (np.stack(list(entry.values())) for entry in (inputs, labels, sad))
+        else:
+            inputs, labels, sad = (np.expand_dims(entry, 0) for entry in (inputs, labels, sad))
+
+        # store as contiguous float32 arrays, so they aren't converted again whenever they are fed
+        inputs, labels, sad = (np.ascontiguousarray(entry, dtype=np.float32) for entry in (inputs, labels, sad))
+
+        return {self.block_inputs: inputs, self.block_labels: labels, self.block_sad: sad}
 
 
 class CompetitionCNN(CompetitionBaseCNN):
@@ -215,54 +333,69 @@ class CompetitionCNN(CompetitionBaseCNN):
     uses gradient clipping by norm
     """
     def __init__(self, sess, cfg):
-        super().__init__(sess, cfg)
+        super().__init__(sess, cfg, num_branches=15)
 
         self.weights = {
             'w1': tf.get_variable('w1', shape=[9, 9, 1, 64],
                                   initializer=tf.contrib.layers.variance_scaling_initializer()),
             'w2': tf.get_variable('w2', shape=[1, 1, 64, 32],
                                   initializer=tf.contrib.layers.variance_scaling_initializer()),
-            'w3': tf.get_variable('w3', shape=[5, 5, 32, 15],
+            'w3': tf.get_variable('w3', shape=[5, 5, 32, self.num_branches],
                                   initializer=tf.contrib.layers.variance_scaling_initializer())
         }
 
         # parameter half_kernel needed for residual learning
         self.calculate_half_kernel_size()
 
-        self.pred = self.linear_model()
+        # compile the forward pass and the loss with XLA, fusing the convolutions with the loss reductions
+        with tf.xla.experimental.jit_scope():
+            self.pred = self.linear_model()
+
+            # add the learned residual to the cropped input in the graph, for testing
+            self.pred_plus_input = self.pred + self.inputs[:, self.half_kernel:-self.half_kernel,
+                                                           self.half_kernel:-self.half_kernel, :]
 
-        self.loss = self.calculate_loss()
+            # losses of the training stages (all branches, specific branch, best branch(es)),
+            # only the loss of the current stage is fetched in training, validation and logging
+            self.stage_losses = self.calculate_loss()
 
-        # gradient clipping by norm
+        # separate training operations per stage, sharing the optimizer, chosen by the epoch number in training
         optimizer = tf.train.AdamOptimizer(self.cfg.learning_rate)
-        self.gradients, variables = zip(*optimizer.compute_gradients(self.loss))
-        self.gradients, _ = tf.clip_by_global_norm(self.gradients, self.cfg.gradient_clip)
-        self.train_op = optimizer.apply_gradients(zip(self.gradients, variables))
+        self.train_ops = [self.stage_train_op(optimizer, loss) for loss in self.stage_losses]
+
+        self.validation_mean()
 
         self.saver = tf.train.Saver()
 
-    def calculate_loss(self):
-        cost = self.complex_loss(self.cfg.loss, self.weights[list(self.weights.keys())[-1]].get_shape()[-1].value)
+    def stage_train_op(self, optimizer, loss):
+        """
+        Create the training operation of a training stage, using gradient clipping by norm
+        :param optimizer: optimizer shared by the training stages
+        :param loss: loss of the training stage
+        :return: training operation
+        """
+        gradients, variables = zip(*optimizer.compute_gradients(loss))
+        gradients, _ = tf.clip_by_global_norm(gradients, self.cfg.gradient_clip)
 
-        def vvc_competition():
-            # find minimum loss across branches for each block in batch
-            nn_loss = tf.reduce_min(cost, axis=1)
+        # skip the update inside the graph if the loss is nan (no branch is better than VVC),
+        # so that a single session run per batch suffices
+        return tf.cond(tf.is_nan(loss), tf.no_op, lambda: optimizer.apply_gradients(zip(gradients, variables)))
 
-            # stack best NN loss and VVC loss to find which one is better
-            comp_loss = tf.stack([nn_loss, self.vvc_loss])
-            idx = tf.math.argmax(comp_loss, 0)
-            mask = tf.cast(idx, tf.bool)
+    def calculate_loss(self):
+        cost = self.complex_loss(self.cfg.loss, self.num_branches)
 
-            # retain only NN losses which are lower than VVC loss
-            nn_loss = tf.boolean_mask(nn_loss, mask)
+        # update all branches in epoch 0
+        loss_all = tf.reduce_mean(cost)
 
-            return nn_loss
+        # update specific branch in epoch 1, chosen per block in batch by its subset
+        loss_subset = tf.reduce_mean(tf.reduce_sum(cost * tf.one_hot(self.subset, self.num_branches), axis=1))
 
-        # update all branches in epoch 0, update specific branch in epoch 1, update best branch(es) in other epochs
-        cost = tf.cond(tf.math.greater(self.epoch, 0),
-                       lambda: tf.cond(tf.math.greater(self.epoch, 1),
-                                       vvc_competition,
-                                       lambda: tf.slice(cost, [0, self.subset], [self.batch_size, 1])),
-                       lambda: tf.reduce_mean(cost, axis=1))
+        # update best branch(es) in other epochs: find minimum loss across branches for each block in batch,
+        # average only NN losses which are lower than VVC loss, the loss is nan if there are none
+        nn_loss = tf.reduce_min(cost, axis=1)
+        mask = tf.math.less(nn_loss, self.vvc_loss)
+        nn_loss = tf.reduce_sum(tf.where(mask, nn_loss, tf.zeros_like(nn_loss)))
+        count = tf.reduce_sum(tf.cast(mask, tf.float32))
+        loss_vvc = tf.where(tf.math.greater(count, 0), nn_loss / tf.maximum(count, 1), tf.constant(np.nan))
 
-        return tf.reduce_mean(cost, name="loss")
+        return [loss_all, loss_subset, loss_vvc]
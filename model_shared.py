@@ -45,7 +45,8 @@ class SharedBaseCNN(BaseCNN):
         super().__init__(sess, cfg)
 
         self.subset = tf.placeholder(tf.int32, name='subset')
-        self.batch_size = tf.placeholder(tf.int32, name='batch_size')
+
+        self.pred_plus_input = None
 
     def train(self):
         """
@@ -125,10 +126,8 @@ class SharedBaseCNN(BaseCNN):
 
                 for idx in range(batch_test):
                     feed_dict = self.shared_feed_dict(test_data[block][frac], test_label[block][frac], idx, i)
-                    res = self.sess.run([self.pred], feed_dict=feed_dict)
-                    cropped_input = feed_dict[self.inputs][:, self.half_kernel:-self.half_kernel,
-                                                           self.half_kernel:-self.half_kernel, :]
-                    result = np.vstack([result, res[0] + cropped_input]) if result.size else res[0] + cropped_input
+                    res = self.sess.run([self.pred_plus_input], feed_dict=feed_dict)
+                    result = np.vstack([result, res[0]]) if result.size else res[0]
 
                 # calculate SAD NN loss and compare it to VVC loss
                 nn_cost, vvc_cost, switch_cost = calculate_test_error(result,
@@ -153,10 +152,10 @@ class SharedBaseCNN(BaseCNN):
         :param labels: label data
         :param i: index pointing to the current position within the data
         :param subset: index indicating which branch of the output layer to update
-        :return a batch-sized dictionary of inputs / labels / subset / batch_size
+        :return a batch-sized dictionary of inputs / labels / subset
         """
         feed_dict = self.prepare_feed_dict(inputs, labels, i)
-        feed_dict.update({self.subset: subset, self.batch_size: len(feed_dict[self.inputs])})
+        feed_dict[self.subset] = subset
         return feed_dict
 
 
@@ -182,6 +181,10 @@ class SharedCNN(SharedBaseCNN):
 
         self.pred = self.linear_model()
 
+        # add the learned residual to the cropped input in the graph, for testing
+        self.pred_plus_input = self.pred + self.inputs[:, self.half_kernel:-self.half_kernel,
+                                                       self.half_kernel:-self.half_kernel, :]
+
         self.loss = self.calculate_loss()
 
         self.train_op = tf.train.AdamOptimizer(self.cfg.learning_rate).minimize(self.loss)
@@ -192,6 +195,6 @@ class SharedCNN(SharedBaseCNN):
         cost = self.complex_loss(self.cfg.loss, self.weights[list(self.weights.keys())[-1]].get_shape()[-1].value)
 
         # Update the branch of the subset
-        cost = tf.slice(cost, [0, self.subset], [self.batch_size, 1])
+        cost = cost[:, self.subset:self.subset + 1]
 
         return tf.reduce_mean(cost, name="loss")